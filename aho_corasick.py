@@ -0,0 +1,53 @@
+from collections import deque
+
+class Automaton(object):
+    def __init__(self,words=()):
+        self.goto=[{}]
+        self.fail=[0]
+        self.out=[set()]
+        for word,value in words:
+            self.add(word,value)
+        self.build()
+
+    def add(self,word,value):
+        if not word:
+            return
+        state=0
+        for char in word:
+            if char not in self.goto[state]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append(set())
+                self.goto[state][char]=len(self.goto)-1
+            state=self.goto[state][char]
+        self.out[state].add(value)
+
+    def build(self):
+        queue=deque(self.goto[0].values())
+        while queue:
+            state=queue.popleft()
+            for char,child in self.goto[state].items():
+                queue.append(child)
+                fail=self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail=self.fail[fail]
+                fail=self.goto[fail].get(char,0)
+                self.fail[child]=fail
+                self.out[child]|=self.out[self.fail[child]]
+
+    def iter(self,text):
+        state=0
+        for char in text:
+            while state and char not in self.goto[state]:
+                state=self.fail[state]
+            state=self.goto[state].get(char,0)
+            if self.out[state]:
+                yield from self.out[state]
+
+    def find(self,text):
+        return set(self.iter(text))
+
+    def search(self,text):
+        for value in self.iter(text):
+            return True
+        return False
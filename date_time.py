@@ -2,11 +2,30 @@ from datetime import datetime
 import datetime as DT
 import time
 import calendar
+import importlib.util
+from functools import lru_cache
+# batch conversion, imported on first use since loading numpy dominates startup
+has_numpy=importlib.util.find_spec("numpy") is not None
 class Clock(object):
+    months=[
+        "Unesamber","Dutesamber","Trisesamber",
+        "Tetresamber","Pentesamber","Hexesamber",
+        "Sevesamber","Octesamber","Novesamber",
+        "Desamber","Undesamber","Dodesamber",
+        "Tridesamber","Year Day","Leap Day"
+    ]
+    resolution=24*60*60/1000000 # seconds per displayed clock unit
+    batch_size=64 # smaller batches are converted one by one
     def __init__(self,offset=None):
         self.timezone=None
+        self.memo=None
         if offset is not None:
             self.timezone=DT.timezone(DT.timedelta(hours=offset))
+    @classmethod
+    @lru_cache(maxsize=64)
+    def get(cls,offset=None):
+        "Shared Clock for a timezone offset"
+        return cls(offset)
     def to_str(self,timestamp=None,with_orig=False):
         if not timestamp:
             timestamp=datetime.now(self.timezone)
@@ -16,24 +35,14 @@ class Clock(object):
     def date(self,D=None):
         if D is None:
             D=datetime.now(self.timezone)
-        months=[
-            "Unesamber","Dutesamber","Trisesamber",
-            "Tetresamber","Pentesamber","Hexesamber",
-            "Sevesamber","Octesamber","Novesamber",
-            "Desamber","Undesamber","Dodesamber",
-            "Tridesamber","Year Day","Leap Day"
-        ]
+        months=self.months
         D=D.timetuple()
         yd=D.tm_yday-1
-        if calendar.isleap(D.tm_year):
-            if yd==365:
-                return "Leap Day"
-            if yd==366:
-                return "Year Day"
-        elif yd==365:
-            return "Year Day"
-        P=yd/(365+int(calendar.isleap(D.tm_year)))
-        month=int(P*(len(months)-2))
+        if yd==365:
+            month=14 if calendar.isleap(D.tm_year) else 13
+        else:
+            P=yd/(365+int(calendar.isleap(D.tm_year)))
+            month=int(P*(len(months)-2))
         month_name=months[month]
         day=((yd-1)%28)+1
         ret={"month_name":month_name,"month":month+1,"day":day,"year":D.tm_year}
@@ -47,8 +56,17 @@ class Clock(object):
         T=T.replace(".",":")
         return {"clock":T,"above":T.split(":")[0],"below":T.split(":")[1]}
     def as_dict(self,D=None):
-        if D is None:
-            D=datetime.now(self.timezone)
+        if D is not None:
+            return self._as_dict(D)
+        # the current time only changes what is displayed once per clock unit
+        unit=int(time.time()/self.resolution)
+        memo=self.memo
+        if memo is None or memo[0]!=unit:
+            memo=self.memo=(unit,self._as_dict(datetime.now(self.timezone)))
+        ret=dict(memo[1])
+        ret['calendar']=dict(ret['calendar'])
+        return ret
+    def _as_dict(self,D):
         ret={'calendar':{
                 "day":D.day,
                 "month":D.month,
@@ -63,4 +81,88 @@ class Clock(object):
         ret.update(self.time(D))
         ret['timestamp']="{month_name} {day}, {year} {clock}".format(**ret)
         return ret
+    def to_str_many(self,timestamps):
+        return [str(t) for t in self.as_arrays(timestamps)['timestamp']]
+    def as_arrays(self,timestamps):
+        "Date and clock fields of as_dict (without calendar) for a batch of datetimes, datetime64 values or epoch seconds"
+        if not has_numpy or len(timestamps)<self.batch_size:
+            rows=[self.as_dict(self._to_datetime(t)) for t in timestamps]
+            keys=("month_name","month","day","year","date","clock","above","below","timestamp")
+            return {k:[row[k] for row in rows] for k in keys}
+        import numpy as np
+        wall=self._wall_times(timestamps)
+        seconds=wall.astype('datetime64[s]')
+        micro=(wall-seconds).astype(np.int64)
+        seconds=seconds.astype(np.int64)
+        T=(micro/1000000+self._mktime(seconds))%(24*60*60)
+        clock=np.char.replace(np.char.mod("%07.3f",(T/(24*60*60))*1000),".",":")
+        day64=wall.astype('datetime64[D]')
+        year64=day64.astype('datetime64[Y]')
+        year=year64.astype(np.int64)+1970
+        yd=(day64-year64).astype(np.int64)
+        leap=(year%4==0)&((year%100!=0)|(year%400==0))
+        month=((yd/(365+leap.astype(np.int64)))*(len(self.months)-2)).astype(np.int64)
+        month=np.where(yd==365,np.where(leap,14,13),month)
+        ret={
+            "month_name":np.array(self.months)[month],
+            "month":month+1,
+            "day":((yd-1)%28)+1,
+            "year":year,
+            "clock":clock,
+            "above":np.char.partition(clock,":")[...,0],
+            "below":np.char.partition(clock,":")[...,2],
+        }
+        ret['date']=np.array(["{} {}, {}".format(*v) for v in zip(ret['month_name'],ret['day'],ret['year'])])
+        ret['timestamp']=np.array(["{} {}".format(*v) for v in zip(ret['date'],clock)])
+        return ret
+    def _mktime(self,seconds):
+        # time.mktime() of wall times given as seconds, using one local offset per hour
+        # except around DST changes, where the result may depend on the exact time
+        import numpy as np
+        hours,inverse=np.unique(seconds//3600,return_inverse=True)
+        offset=lambda h:h*3600-time.mktime(time.gmtime(h*3600)[:8]+(-1,))
+        offsets=np.array([[offset(h-1),offset(h),offset(h+1)] for h in hours.tolist()]).reshape(-1,3)
+        ret=seconds-offsets[inverse.reshape(seconds.shape),1]
+        unstable=np.flatnonzero(((offsets[:,0]!=offsets[:,1])|(offsets[:,1]!=offsets[:,2]))[inverse])
+        flat=ret.reshape(-1)
+        for n in unstable.tolist():
+            flat[n]=time.mktime(time.gmtime(int(seconds.reshape(-1)[n]))[:8]+(-1,))
+        return ret
+    def _local_offsets(self,seconds):
+        # local utc offsets of epoch seconds, per hour unless the offset changes nearby
+        import numpy as np
+        hours,inverse=np.unique(seconds//3600,return_inverse=True)
+        offset=lambda h:time.localtime(h*3600).tm_gmtoff
+        offsets=np.array([[offset(h),offset(h+1)] for h in hours.tolist()]).reshape(-1,2)
+        ret=offsets[inverse.reshape(seconds.shape),0].astype(np.float64)
+        flat,whole=ret.reshape(-1),seconds.reshape(-1)
+        for n in np.flatnonzero((offsets[:,0]!=offsets[:,1])[inverse]).tolist():
+            flat[n]=time.localtime(whole[n]).tm_gmtoff
+        return ret
+    def _to_datetime(self,timestamp):
+        if getattr(timestamp,"dtype",None) is not None:
+            timestamp=(timestamp.astype('datetime64[us]') if timestamp.dtype.kind=="M" else timestamp).item()
+        if not timestamp:
+            return datetime.now(self.timezone)
+        if isinstance(timestamp,(int,float)):
+            return datetime.fromtimestamp(timestamp,self.timezone)
+        return timestamp
+    def _wall_times(self,timestamps):
+        # naive datetime64[us] wall clock times, as seen by the scalar path
+        import numpy as np
+        values=np.asarray(timestamps)
+        if values.dtype.kind=="M":
+            return values.astype('datetime64[us]')
+        if values.dtype.kind in "iuf":
+            frac,whole=np.modf(values.astype(np.float64))
+            micro=np.round(frac*1e6)
+            whole=whole+(micro>=1000000)-(micro<0)
+            micro=micro-1000000*(micro>=1000000)+1000000*(micro<0)
+            if self.timezone is not None:
+                offset=self.timezone.utcoffset(None).total_seconds()
+            else:
+                offset=self._local_offsets(whole)
+            return ((whole+offset).astype(np.int64)*1000000+micro.astype(np.int64)).astype('datetime64[us]')
+        wall=[self._to_datetime(t).replace(tzinfo=None) for t in values.ravel().tolist()]
+        return np.array(wall,dtype='datetime64[us]').reshape(values.shape)
 Clock().time()
\ No newline at end of file
@@ -1,6 +1,7 @@
-import re
-from dateutil.parser import parse
-from vessel import Vessel,Forum,InvalidVesselException,engine,session
+import os
+from sqlalchemy import select
+from memory_array import read_memory_array,memory_array_columns,parse_date
+from vessel import Vessel,Forum,engine,session,transaction,index
 from tqdm import tqdm
 import urllib.request
 import codecs
@@ -33,28 +34,6 @@ program_to_jinja={
     #"random":"",
 }
 
-def parse_memory_array(data):
-    value_slices=[]
-    for line in data.splitlines():
-        if not line.strip():
-            continue
-        if line.startswith("~"):
-            continue
-        if line.startswith("@ "):
-            line=line.strip("@ ")
-            first_word=line.split()[0]
-            line=line.replace(first_word,first_word+"  ")
-            for match in re.finditer("(\w+)\s*",line):
-                value_slices.append((match.groups()[0].lower(),list(match.span())))
-            value_slices[-1][1][1]=None
-            value_slices=dict(value_slices)
-            for k,v in value_slices.items():
-                value_slices[k]=slice(*v)
-        else:
-            data={}
-            for k,v in value_slices.items():
-                data[k]=line[v].strip()
-            yield data
 def to_jinja(code):
     #return code
     if code and ("((" in code) and ("))" in code):
@@ -63,65 +42,64 @@ def to_jinja(code):
             code=code.replace(chunk," {} ".format(program_to_jinja[chunk]))
             code=code.replace("((","<( ").replace("))"," )>")
     return code
+def fetch(url):
+    "Local path of a snapshot, downloading it to a temporary file unless url already is one"
+    if os.path.exists(url):
+        return url
+    path,headers=urllib.request.urlretrieve(url)
+    return path
+def read_records(path):
+    columns=memory_array_columns(path)
+    for row in read_memory_array(path):
+        yield dict(zip(columns,row))
 Vessel.metadata.drop_all(engine)
 Vessel.metadata.create_all(engine)
 vessel_url="https://raw.githubusercontent.com/XXIIVV/vessel.paradise/master/memory/paradise.ma"
-vessels=str(urllib.request.urlopen(vessel_url).read(),"utf-8")
-dropped=0
+forum_url="https://raw.githubusercontent.com/XXIIVV/vessel.paradise/master/memory/forum.ma"
+def vessel_records(path):
+    for id_val,record in enumerate(tqdm(read_records(path),ascii=True,disable=False)):
+        record['id']=id_val
+        state,parent,owner,created=record['code'].split("-")
+        record['parent_id']=int(parent.lstrip("0") or "0")
+        record['owner_id']=int(owner.lstrip("0") or "0")
+        record['created_raw']=created.lstrip("0") or None
+        if record['created_raw']:
+            record['created_raw']=parse_date(record['created_raw'])
+        state={attr:val=="1" for attr,val in zip(("locked","hidden","silent","tunnel"),state)}
+        record.update(state)
+        del record['code']
+        record['raw_note']=record['note']
+        del record['note']
+        for k,v in record.items():
+            if isinstance(v,str):
+                record[k]=to_jinja(v)
+        if not record['name']:
+            record['name']="nullspace"
+        yield record
+def forum_records(path):
+    for id_val,record in enumerate(tqdm(read_records(path),ascii=True)):
+        record['from_id']=int(record['from'].lstrip("0") or "0")
+        del record['from']
+        record['host_id']=int(record['host'].lstrip("0")  or "0")
+        del record['host']
+        record['timestamp_raw']=record['timestamp'].lstrip("0") or None
+        del record['timestamp']
+        if record['timestamp_raw']:
+            record['timestamp_raw']=parse_date(record['timestamp_raw'])
+        record['id']=id_val
+        yield record
 print("Importing Vessels...")
-for id_val,record in enumerate(tqdm(list(parse_memory_array(vessels)),ascii=True,disable=False)):
-    record['id']=id_val
-    state,parent,owner,created=record['code'].split("-")
-    record['parent_id']=int(parent.lstrip("0") or "0")
-    record['owner_id']=int(owner.lstrip("0") or "0")
-    record['created_raw']=created.lstrip("0") or None
-    if record['created_raw']:
-        record['created_raw']=parse(record['created_raw'])
-    state={attr:val=="1" for attr,val in zip(("locked","hidden","silent","tunnel"),state)}
-    record.update(state)
-    del record['code']
-    record['raw_note']=record['note']
-    del record['note']
-    for k,v in record.items():
-        if isinstance(v,str):
-            record[k]=to_jinja(v)
-    if not record['name']:
-        record['name']="nullspace"
-    try:
-        orig_locked=record['locked']
-        record['locked']=False
-        Vessel(**record).locked=orig_locked
-    except InvalidVesselException as e:
-        dropped+=1
-    """
-    if " ".join([record['attr'],record['name']]).strip():
-        Vessel(**record)
-    else:
-        dropped+=1
-    """
-Vessel.update()
-for v in Vessel.universe:
-    if v.parent is None:
-        v.parent_id=0
-Vessel.update()
-print("Dropped {} Vessels".format(dropped))
-dropped=0
+with transaction():
+    # rows go to the database batch by batch as they are parsed
+    loaded,dropped=Vessel.load_many(vessel_records(fetch(vessel_url)))
+    # vessels whose parent was dropped or never exported end up in the nexus
+    session.execute(Vessel.__table__.update().where(
+        (Vessel.parent_id==None)|~Vessel.parent_id.in_(select([Vessel.id]))
+    ).values(parent_id=0))
+index.reset()
+print("Dropped {} Vessels".format(len(dropped)))
 print("Importing Forum...")
-forum_url="https://raw.githubusercontent.com/XXIIVV/vessel.paradise/master/memory/forum.ma"
-forum=str(urllib.request.urlopen(forum_url).read(),"utf-8")
-for id_val,record in enumerate(tqdm(list(parse_memory_array(forum)),ascii=True)):
-    record['from_id']=int(record['from'].lstrip("0") or "0")
-    del record['from']
-    record['host_id']=int(record['host'].lstrip("0")  or "0")
-    del record['host']
-    record['timestamp_raw']=record['timestamp'].lstrip("0") or None
-    del record['timestamp']
-    if record['timestamp_raw']:
-        record['timestamp_raw']=parse(record['timestamp_raw'])
-    record['id']=id_val
-    try:
-        Forum(**record)
-    except AssertionError:
-        dropped+=1
-Forum.update()
-print("Dropped {} Messages".format(dropped))
\ No newline at end of file
+vessel_ids={id_n for id_n, in session.query(Vessel.id)}
+posted,rejected=Forum.load_many(forum_records(fetch(forum_url)),vessel_ids=vessel_ids)
+print("Dropped {} Messages".format(len(rejected)))
+urllib.request.urlcleanup()
\ No newline at end of file
@@ -2,24 +2,66 @@ print("Loading...")
 import os
 import io
 import sys
+import time
+import builtins
+started=time.perf_counter()
+
+class ImportProfile(object):
+    "Records cumulative and self time of every module imported while installed"
+    def __init__(self):
+        self.times={}
+        self.stack=[]
+        self.original=builtins.__import__
+        builtins.__import__=self.timed_import
+    
+    def timed_import(self,name,globals=None,locals=None,fromlist=(),level=0):
+        args=(globals,locals,fromlist,level)
+        if level:
+            package=(globals or {}).get("__package__") or ""
+            package=package.rsplit(".",level-1)[0]
+            name=".".join(filter(None,(package,name)))
+            args=(globals,locals,fromlist,0)
+        if name in sys.modules:
+            return self.original(name,*args)
+        self.stack.append(0.0)
+        start=time.perf_counter()
+        try:
+            return self.original(name,*args)
+        finally:
+            total=time.perf_counter()-start
+            children=self.stack.pop()
+            if self.stack:
+                self.stack[-1]+=total
+            self.times[name]=(total,total-children)
+    
+    def report(self,file=sys.stderr,limit=30):
+        builtins.__import__=self.original
+        print("Startup took {:.1f} ms".format((time.perf_counter()-started)*1000),file=file)
+        print("{:>10} {:>10}  module".format("total ms","self ms"),file=file)
+        for name,(total,own) in sorted(self.times.items(),key=lambda item:-item[1][0])[:limit]:
+            print("{:>10.1f} {:>10.1f}  {}".format(total*1000,own*1000,name),file=file)
+
+import_profile=ImportProfile() if "--startup-profile" in sys.argv else None
 import cmd
 import types
 import base64
 import codecs
-import random
+import re
+import queue
 import getpass
+import threading
 import textwrap
-import readline
 import argparse
 import traceback
-from functools import wraps,partial
+from functools import wraps,partial,lru_cache
+from collections.abc import Mapping
 from datetime import datetime,timedelta
-import code
 import importlib
-try:
-    import lupa # scripting
-    import lupa._lupa # scripting
-    has_lua=True
+import importlib.util
+# lupa is only imported when a Lua program first runs, every connection then builds its own runtime, see Cmd_Parser.lua
+has_lua=importlib.util.find_spec("lupa") is not None # scripting
+lupa=None
+if has_lua:
     LUA_LIMIT=1e8
     lua_whitelist=['assert','string','math',
                    'table','type','ipairs',
@@ -53,16 +95,13 @@ try:
     python_whitelist=['builtins','math','re','string','cmath','functools','time','datetime']
     python_blacklist=['time.sleep','builtins.quit','builtins.exit',
                       'builtins.globals','builtins.locals','builtins.eval','builtins.exec']
-except ImportError:
-    lua=None
-    has_lua=False
 import jinja2
 import jinja2.meta
 import jinja2.sandbox
 
 from date_time import Clock
 from vessel import Vessel,Ghost,Forum,User,InvalidVesselException
-from vessel import split_vessel_name,clean_vessel_name,engine
+from vessel import split_vessel_name,clean_vessel_name,engine,render_scope,index,session,transaction,release_connection
 
 #if not os.path.isfile("universe.db"):
 #    import import_snapshot
@@ -90,8 +129,8 @@ def lformat(iterable, pattern="{}"):
         if hasattr(value,"dict"):
             value=value.dict
         try:
-            if isinstance(value,dict):
-                yield pattern.format(**value)
+            if isinstance(value,Mapping):
+                yield pattern.format_map(value)
             else:
                 yield pattern.format(value)
         except:
@@ -99,6 +138,33 @@ def lformat(iterable, pattern="{}"):
 jinja = Sandbox()
 jinja.filters['lformat']=lformat
 
+@lru_cache(maxsize=256)
+def compile_template(cmd):
+    "Parse and compile a normalized template once, returns the template and its undeclared variables"
+    try:
+        template=jinja.parse(cmd)
+    except:
+        print(cmd)
+        raise
+    template=Cmd_Visitor().visit(template)
+    template=template.set_environment(jinja)
+    return jinja.from_string(template),frozenset(jinja2.meta.find_undeclared_variables(template))
+
+template_context={
+    'vessel':lambda parser,vessel,target:vessel,
+    'location':lambda parser,vessel,target:parser.vessel.parent if parser.vessel else parser.location,
+    'universe':lambda parser,vessel,target:Vessel.universe,
+    'atlas':lambda parser,vessel,target:Vessel.atlas,
+    'spells':lambda parser,vessel,target:Vessel.spells,
+    'tunnels':lambda parser,vessel,target:Vessel.tunnels,
+    'time':lambda parser,vessel,target:Clock.get().as_dict(),
+    'nataniev':lambda parser,vessel,target:lambda tz:Clock.get(tz).as_dict(),
+    'find':lambda parser,vessel,target:lambda id_n:Vessel.find_distant(id_n),
+    'target':lambda parser,vessel,target:target,
+}
+# computed at most once per command (see Cmd_Parser.precmd and postcmd)
+command_context=frozenset(['universe','atlas','spells','tunnels','time'])
+
 def eval_template(parser,cmd,vessel,target=None,recursive=False):
     if cmd.startswith("lua:"):
         cmd=bytes(cmd[4:],"utf-8")
@@ -116,30 +182,19 @@ def eval_template(parser,cmd,vessel,target=None,recursive=False):
         cmd=cmd.replace("##","").replace("##","")
         if "<(" in cmd and ")>" in cmd:
             cmd=cmd.replace("<(","{{ ").replace(")>"," }}")
-        T_now=datetime.today()
-        args={
-            'vessel':vessel,
-            'location':((lambda:parser.vessel.parent) if parser.vessel else (lambda:parser.location))(),
-            'universe':Vessel.universe,
-            'atlas':Vessel.atlas,
-            'spells':Vessel.spells,
-            'tunnels':Vessel.tunnels,
-            'time':Clock().as_dict(),
-            'nataniev':lambda tz:Clock(tz).as_dict(),
-            'find':lambda id_n:Vessel.find_distant(id_n),
-            'target':target,
-        }
-        try:
-            template=jinja.parse(cmd)
-        except:
-            print(cmd)
-            raise
-        template=Cmd_Visitor().visit(template)
-        template=template.set_environment(jinja)
-        for var in jinja2.meta.find_undeclared_variables(template):
-            if var not in args:
+        template,variables=compile_template(cmd)
+        args={}
+        for var in variables:
+            if var not in template_context:
                 raise jinja2.exceptions.UndefinedError("'{}' is undefined".format(var))
-        cmd=jinja.from_string(template).render(args)
+            if var in command_context:
+                if var not in parser.template_cache:
+                    parser.template_cache[var]=template_context[var](parser,vessel,target)
+                args[var]=parser.template_cache[var]
+            else:
+                args[var]=template_context[var](parser,vessel,target)
+        with render_scope():
+            cmd=template.render(args)
         if not recursive:
             return cmd
         if cmd==old_cmd:
@@ -167,17 +222,26 @@ def modifies_vessel(func):
     wrapped.modifies_vessel=True
     return wrapped
 
+def read_input(read=input,*args,**kwargs):
+    "Read user input without holding a transaction, and with it SQLite's write lock, open while waiting"
+    session.commit()
+    return read(*args,**kwargs)
+
 class Cmd_Parser(cmd.Cmd):
     prompt="> "
     use_rawinput=True
-    def __init__(self,location=None,*,test_mode=False):
+    def __init__(self,location=None,*,test_mode=False,conninfo=None):
+        self.remote=conninfo
         self.user_cmds=set()
         self.in_program = False
         self.vessel=None
         self.user=None
         self.forum_size=5
+        self.forum_page=50
         self.recursion_limit=50
         self.stack=[]
+        self.template_cache={}
+        self.lua_runtime=None
         if test_mode:
             self.visible_count=None
         else:
@@ -188,17 +252,9 @@ class Cmd_Parser(cmd.Cmd):
             else:
                 self.location=Vessel.get(location)
         else:
-            VL=Vessel.find((Vessel.locked==False) & (Vessel.hidden==False) & (Vessel.id!=0))
-            VL=VL.all()
-            random.shuffle(VL)
-            for self.location in VL:
-                if any([
-                    self.location.parent is None,
-                    ]):
-                    continue
-                if self.location.rating<50:
-                    continue
-                break
+            spawn_id=index.spawn_id()
+            if spawn_id is not None:
+                self.location=Vessel.get(spawn_id)
             else:
                 print("No suitable Location found, picking a random one...")
                 self.location=Vessel.random()
@@ -217,6 +273,8 @@ class Cmd_Parser(cmd.Cmd):
     
     @property
     def conninfo(self):
+        if getattr(self,"remote",None):
+            return self.remote
         nc=(os.environ.get("NCAT_REMOTE_ADDR",None),os.environ.get("NCAT_REMOTE_PORT",None))
         ssh=os.environ.get("SSH_CONNECTION",None)
         if all(nc):
@@ -250,13 +308,15 @@ class Cmd_Parser(cmd.Cmd):
     
     def cmdloop(self):
         self.cmdqueue.append("")
-        return super(type(self),self).cmdloop(self.intro)
+        return super().cmdloop(self.intro)
     
     def precmd(self,line):
         line=line.strip()
         if not line:
             return line
         Vessel.update()
+        Vessel.sync()
+        self.template_cache.clear()
         if self.conninfo:
             host,port=self.conninfo
             print("[{}] {}:{}|{}{}".format(datetime.now(),host,port,self.prompt,line),file=sys.stderr)
@@ -264,7 +324,8 @@ class Cmd_Parser(cmd.Cmd):
         if cmd in ["program","note"]:
             return line
         try:
-            return eval_template(self,line,self.vessel)
+            with transaction():
+                return eval_template(self,line,self.vessel)
         except Exception as e:
             if self.test_mode:
                 raise
@@ -276,6 +337,7 @@ class Cmd_Parser(cmd.Cmd):
         if not line:
             return
         Vessel.update()
+        self.template_cache.clear()
         if line.split()[0] in ["look","inspect","shell","help","print"]:
             print()
             return
@@ -306,7 +368,7 @@ class Cmd_Parser(cmd.Cmd):
             if self.vessel.parent.note.strip():
                 print()
                 print(eval_template(self,self.vessel.parent.note,self.vessel).strip())
-            forum=self.vessel.parent.forum[-self.forum_size:]
+            forum=self.vessel.parent.messages(self.forum_size)
             if forum and not line.strip().startswith("forum"):
                 print()
                 for message in forum:
@@ -338,7 +400,7 @@ class Cmd_Parser(cmd.Cmd):
             if self.location.note.strip():
                 print()
                 print(eval_template(self,self.location.note,self.vessel or Ghost()).strip())
-            forum=self.location.forum[-self.forum_size:]
+            forum=self.location.messages(self.forum_size)
             if forum and not line.strip().startswith("forum"):
                 print()
                 print("Last {} messages".format(self.forum_size))
@@ -349,12 +411,17 @@ class Cmd_Parser(cmd.Cmd):
         print()
         return super().postcmd(stop,line)
     
+    def onecmd(self,line):
+        # nested script/use/cast lines join the transaction of the command that runs them
+        with transaction():
+            return super().onecmd(line)
+    
     def emptyline(self):
         return
     
     def default(self,cmd):
         #TODO: check onbjects for do_{cmd} method, execute command
-        return super(type(self),self).default(cmd)
+        return super().default(cmd)
     
     def script(self,*args,silent=False):
         self.stack.append(self.location)
@@ -374,6 +441,7 @@ class Cmd_Parser(cmd.Cmd):
     
     def do_rl(self,cmd):
         "Change readline configuration"
+        import readline
         return readline.parse_and_bind(cmd)
     
     def do_look(self,name):
@@ -409,13 +477,13 @@ class Cmd_Parser(cmd.Cmd):
             if self.location.note.strip():
                 print()
                 print(eval_template(self,self.location.note,self.vessel or Ghost()).strip())
-            forum=self.location.forum[-self.forum_size:]
+            forum=self.location.messages(self.forum_size)
             if forum:
                 print()
                 print("Last {} messages".format(len(forum)))
                 for message in forum:
                     print(message['rendered'])
-            visible=self.location.children.all()
+            visible=self.location.children
             print()
             if not visible:
                 print("You can see nothing")
@@ -425,16 +493,23 @@ class Cmd_Parser(cmd.Cmd):
                 print(" -",vessel.full_name_with_id)
     
     def do_forum(self,name):
-        "Print message log"
+        "Print message log, pass a message id to show older messages"
+        before=None
         if name:
-            print("forum takes no arguments")
-            return
+            try:
+                before=int(name)
+            except ValueError:
+                print("forum takes an optional message id")
+                return
         if self.vessel:
-            forum=self.vessel.parent.forum
+            forum=self.vessel.parent.messages(self.forum_page+1,before)
         else:
-            forum=self.location.forum
+            forum=self.location.messages(self.forum_page+1,before)
         if forum:
             print()
+            if len(forum)>self.forum_page:
+                forum=forum[1:]
+                print("Older messages: forum {}".format(forum[0]['id']))
             for message in forum:
                 print(message['rendered'])
         else:
@@ -464,17 +539,18 @@ class Cmd_Parser(cmd.Cmd):
             print("The {} is owned by the {}, has a rating of {}".format(vessel.full_name,vessel.owner.full_name_with_id,vessel.rating),end="")
         else:
             print("The {} is owned by nobody, has a rating of {}".format(vessel.full_name,vessel.rating),end="")
-        if vessel.stem:
-            if vessel.stem.id!=vessel.id:
+        stem=vessel.stem
+        if stem:
+            if stem.id!=vessel.id:
                 depth=vessel.depth
                 if depth>1:
-                    print(" and is currently {} levels deep within the {} paradox".format(vessel.depth,vessel.stem.full_name))
+                    print(" and is currently {} levels deep within the {} paradox".format(depth,stem.full_name))
                 else:
-                    print(" and is currently {} level deep within the {} paradox".format(vessel.depth,vessel.stem.full_name))
+                    print(" and is currently {} level deep within the {} paradox".format(depth,stem.full_name))
             else:
                 print(" and is a paradox".format(vessel.full_name))
-            if vessel.stem.id!=vessel.id:
-                print("Stem:",vessel.stem.full_name_with_id)
+            if stem.id!=vessel.id:
+                print("Stem:",stem.full_name_with_id)
         if vessel.parent.id!=vessel.id:
             print("Parent:",vessel.parent.full_name_with_id)
         if vessel.note:
@@ -641,6 +717,8 @@ class Cmd_Parser(cmd.Cmd):
         def do_shell(self,cmd):
             "Evaluate python code or drop into an interactive shell"
             if not cmd:
+                import code
+                session.commit()
                 try:
                     code.interact(banner="Welcome to the debug console, don't break anything...",local=globals(),exitmsg="Bye!")
                 except SystemExit:
@@ -738,13 +816,22 @@ class Cmd_Parser(cmd.Cmd):
         self.vessel.attr=attr
         self.vessel.name=name
     
+    @property
+    def lua(self):
+        "This connection's Lua runtime and its globals, built on first use"
+        if self.lua_runtime is None:
+            if not load_lua():
+                raise NotImplementedError("lupa module not loaded")
+            self.lua_runtime=init_lua()
+        return self.lua_runtime
+    
     def do_lua_reset(self,args):
         """Reset lua environment"""
-        global lua,lua_globals
         if args:
             print("lua_reset takes no arguments")
             return
-        lua,lua_globals=init_lua()
+        # only this connection's runtime, the next Lua code builds a fresh one
+        self.lua_runtime=None
         print("Lua Environment reset!")
     
     def do_lua(self,args):
@@ -785,7 +872,7 @@ class Cmd_Parser(cmd.Cmd):
             print("Error:",res)
             return
         if not res:
-            res=dict(lua_globals).get('do_'+cmd,None)
+            res=dict(self.lua[1]).get('do_'+cmd,None)
         if not lupa.lua_type(res)=='function':
             print("Error: lua code should return or define a function 'do_"+cmd+"'")
             return
@@ -810,7 +897,7 @@ class Cmd_Parser(cmd.Cmd):
     def read_multiline(self,prompt):
         print(prompt,end="",flush=True)
         while 1:
-            line=input().strip()
+            line=read_input().strip()
             if line==".end":
                 break
             yield line
@@ -831,15 +918,15 @@ class Cmd_Parser(cmd.Cmd):
             spell=clean_vessel_name(name)
             target_name=self.vessel.full_name
             target=self.vessel
-        try:
-            spell_program=next(filter(lambda vessel:vessel.full_name==spell,Vessel.spells)).program
-            if not spell_program.strip():
-                print("Spell vessel does not have a program associated with it")
-                return
-            spell_command=eval_template(self,spell_program,self.vessel,target)
-        except StopIteration:
+        spell_vessel=Vessel.find_spell(spell)
+        if spell_vessel is None:
             print("The {} does not exist".format(spell))
             return
+        spell_program=spell_vessel.program
+        if not spell_program.strip():
+            print("Spell vessel does not have a program associated with it")
+            return
+        spell_command=eval_template(self,spell_program,self.vessel,target)
         if not spell_command:
             return
         if not target:
@@ -882,7 +969,7 @@ class Cmd_Parser(cmd.Cmd):
             return
         message=message.strip()
         if message:
-            msg=Forum(host_id=self.vessel.parent.id,from_id=self.vessel.id,message=message)
+            msg=Forum.post(host_id=self.vessel.parent.id,from_id=self.vessel.id,message=message)
             print(msg.str)
         return
     
@@ -900,19 +987,19 @@ class Cmd_Parser(cmd.Cmd):
             if Vessel.get(int(name)).hidden:
                 print("The {} is hidden".format(Vessel.get(int(name)).full_name))
                 return
-            msg=Forum(host_id=self.vessel.parent.id,from_id=self.vessel.id,message=name)
+            msg=Forum.post(host_id=self.vessel.parent.id,from_id=self.vessel.id,message=name)
         elif name:
             vessel=Vessel.find_distant(name)
             if vessel.hidden:
                 print("The {} is hidden".format(vessel.full_name))
                 return
             if vessel:
-                msg=Forum(host_id=self.vessel.parent.id,from_id=self.vessel.id,message=str(vessel.id))
+                msg=Forum.post(host_id=self.vessel.parent.id,from_id=self.vessel.id,message=str(vessel.id))
             else:
                 print("Invalid argument")
                 return
         else:
-            msg=Forum(host_id=self.vessel.parent.id,from_id=self.vessel.id,message=str(self.vessel.parent.id))
+            msg=Forum.post(host_id=self.vessel.parent.id,from_id=self.vessel.id,message=str(self.vessel.parent.id))
         print(msg.str)
     
     @needs_vessel
@@ -923,7 +1010,7 @@ class Cmd_Parser(cmd.Cmd):
             return
         if message:
             message="me "+message.strip()
-            msg=Forum(host_id=self.vessel.parent.id,from_id=self.vessel.id,message=message)
+            msg=Forum.post(host_id=self.vessel.parent.id,from_id=self.vessel.id,message=message)
             print(msg.str)
         return
     
@@ -961,11 +1048,11 @@ class Cmd_Parser(cmd.Cmd):
         
         if self.conninfo:
             print("Warning: Password input may be echoed.")
-            password=input("Password:")
-            password_v=input("Verify Password:")
+            password=read_input(input,"Password:")
+            password_v=read_input(input,"Verify Password:")
         else:
-            password=getpass.getpass(stream=sys.stdout)
-            password_v=getpass.getpass("Verify Password:",stream=sys.stdout)
+            password=read_input(getpass.getpass,stream=sys.stdout)
+            password_v=read_input(getpass.getpass,"Verify Password:",stream=sys.stdout)
         
         if password!=password_v:
             print("Passwords do not match")
@@ -989,9 +1076,9 @@ class Cmd_Parser(cmd.Cmd):
         username=args
         if self.conninfo:
             print("Warning: Password input may be echoed.")
-            password=input("Password:")
+            password=read_input(input,"Password:")
         else:
-            password=getpass.getpass(stream=sys.stdout)
+            password=read_input(getpass.getpass,stream=sys.stdout)
         user=User.get(username)
         if not user:
             print("User does not exist")
@@ -1096,6 +1183,10 @@ arg_parser.add_argument("-j","--json",action="store_true",help="json output")
 arg_parser.add_argument("-e","--empty",action="store_true",help="start with an empty universe (except for ID 0)")
 arg_parser.add_argument("-l","--location",type=int,help="Start location (default=random) or vessel",default=None)
 arg_parser.add_argument("-db","--database",type=str,help="Database file to use",default="universe.db")
+arg_parser.add_argument("-s","--serve",type=int,metavar="PORT",help="Serve the universe over telnet on PORT",default=None)
+arg_parser.add_argument("-w","--workers",type=int,help="Serve from this many pre-forked worker processes instead of threads",default=None)
+arg_parser.add_argument("--host",type=str,help="Address to listen on in server mode",default="0.0.0.0")
+arg_parser.add_argument("--startup-profile",action="store_true",help="Report import times once the prompt is ready")
 arg_parser.add_argument("commands",type=str,help="Commands to run",default=None,nargs='*')
 args=arg_parser.parse_args()
 #args.json=False
@@ -1126,10 +1217,226 @@ class VesselEncoder(json.JSONEncoder):
 def serialize(data):
     return json.dumps(data,cls=VesselEncoder,sort_keys=True,indent=4)
 
+# server mode: one thread per connection, only one of them runs commands at a time
+world_lock=threading.Lock()
+telnet_command=re.compile(rb"\xff(?:\xfa.*?\xff\xf0|[\xfb-\xfe].|[\xf0-\xf9])",re.S)
+
+def telnet_line(data):
+    data=telnet_command.sub(b"",data).replace(b"\xff\xff",b"\xff")
+    return data.decode("utf-8","replace").rstrip("\r\n\0")+"\n"
+
+class ThreadStream(object):
+    "Forwards to the stream bound to the current thread, or to the default one"
+    def __init__(self,default):
+        self.default=default
+        self.local=threading.local()
+    
+    def bind(self,stream):
+        self.local.stream=stream
+    
+    def __getattr__(self,name):
+        return getattr(getattr(self.local,"stream",self.default),name)
+
+class Connection(object):
+    "Text stream over a client socket, for use from the connection's thread"
+    def __init__(self,loop,writer):
+        self.loop=loop
+        self.writer=writer
+        self.lines=queue.Queue()
+        self.eof=False
+    
+    def feed(self,data):
+        self.lines.put(telnet_line(data) if data else "")
+    
+    def readline(self):
+        if self.eof:
+            return ""
+        world_lock.release()
+        try:
+            line=self.lines.get()
+        finally:
+            world_lock.acquire()
+        self.eof=not line
+        return line
+    
+    def write(self,text):
+        data=text.replace("\n","\r\n").encode("utf-8","replace")
+        self.loop.call_soon_threadsafe(self.writer.write,data)
+        return len(text)
+    
+    def flush(self):
+        pass
+    
+    def close(self):
+        self.loop.call_soon_threadsafe(self.writer.close)
+
+class SocketConnection(object):
+    "Text stream over a blocking client socket"
+    def __init__(self,sock):
+        self.sock=sock
+        self.file=sock.makefile("rb")
+        self.eof=False
+    
+    def readline(self):
+        data=b"" if self.eof else self.file.readline()
+        self.eof=not data
+        return telnet_line(data) if data else ""
+    
+    def write(self,text):
+        try:
+            self.sock.sendall(text.replace("\n","\r\n").encode("utf-8","replace"))
+        except OSError:
+            self.eof=True
+        return len(text)
+    
+    def flush(self):
+        pass
+    
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+def run_session(conn,conninfo):
+    try:
+        # a class per connection, so user defined commands stay with their connection
+        parser=type("Cmd_Parser",(Cmd_Parser,),{})(conninfo=conninfo)
+        while 1:
+            try:
+                parser.cmdloop()
+                break
+            except Exception as e:
+                print("Error:",*e.args)
+                if conn.eof:
+                    break
+    except Exception:
+        traceback.print_exc()
+    finally:
+        print("[{}] Closed connection from {}:{}".format(datetime.now(),*conninfo),file=sys.stderr)
+        session.remove()
+        conn.close()
+
+def run_connection(conn,conninfo):
+    sys.stdin.bind(conn)
+    sys.stdout.bind(conn)
+    with world_lock:
+        try:
+            run_session(conn,conninfo)
+        finally:
+            release_connection()
+
+async def handle_connection(reader,writer):
+    import asyncio
+    conn=Connection(asyncio.get_event_loop(),writer)
+    conninfo=writer.get_extra_info("peername")[:2]
+    threading.Thread(target=run_connection,args=(conn,conninfo),daemon=True).start()
+    while 1:
+        try:
+            line=await reader.readline()
+        except ConnectionError:
+            line=b""
+        conn.feed(line)
+        if not line:
+            break
+
+def serve(host,port):
+    import asyncio
+    load_lua()
+    disable_shell()
+    sys.stdin=ThreadStream(sys.stdin)
+    sys.stdout=ThreadStream(sys.stdout)
+    loop=asyncio.get_event_loop()
+    server=loop.run_until_complete(asyncio.start_server(handle_connection,host,port))
+    print("[{}] Listening on {}:{}".format(datetime.now(),host,port),file=sys.stderr)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    server.close()
+
+def disable_shell():
+    if hasattr(Cmd_Parser,"do_shell"):
+        del Cmd_Parser.do_shell
+
+def worker(listener):
+    import signal
+    # connections opened before the fork must not be shared with the parent
+    signal.signal(signal.SIGTERM,signal.SIG_DFL)
+    engine.dispose()
+    # the index came warm from the parent, only catch up on what changed since
+    Vessel.sync()
+    while 1:
+        sock,addr=listener.accept()
+        conn=SocketConnection(sock)
+        sys.stdin,sys.stdout=conn,conn
+        try:
+            run_session(conn,addr[:2])
+        finally:
+            sys.stdin,sys.stdout=sys.__stdin__,sys.__stdout__
+
+def prefork(host,port,workers):
+    "Serve connections from forked worker processes that share one listening socket"
+    import signal
+    import socket
+    load_lua()
+    disable_shell()
+    listener=socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+    listener.bind((host,port))
+    listener.listen(128)
+    children=set()
+    def spawn():
+        # build the index here once, so every worker starts from a warm copy
+        Vessel.sync()
+        index.spawn_id()
+        index.tunnel_note_ids()
+        release_connection()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid=os.fork()
+        if not pid:
+            try:
+                worker(listener)
+            except KeyboardInterrupt:
+                pass
+            except Exception:
+                traceback.print_exc()
+            finally:
+                os._exit(0)
+        children.add(pid)
+    signal.signal(signal.SIGTERM,lambda signum,frame:sys.exit())
+    for _ in range(workers):
+        spawn()
+    print("[{}] Listening on {}:{} with {} workers".format(datetime.now(),host,port,workers),file=sys.stderr)
+    try:
+        while 1:
+            pid,status=os.wait()
+            if pid in children:
+                children.discard(pid)
+                print("[{}] Worker {} exited, respawning".format(datetime.now(),pid),file=sys.stderr)
+                spawn()
+    except (KeyboardInterrupt,SystemExit):
+        pass
+    finally:
+        signal.signal(signal.SIGTERM,signal.SIG_DFL)
+        for pid in children:
+            try:
+                os.kill(pid,signal.SIGTERM)
+            except OSError:
+                pass
+
+def load_lua():
+    "Import lupa on first use, returns whether Lua is available"
+    global lupa,has_lua
+    if has_lua and lupa is None:
+        try:
+            import lupa
+            import lupa._lupa
+        except ImportError:
+            has_lua=False
+    return has_lua
+
 def lua_eval(code,parser,*,reset=True,**kwargs):
-    #global lua,lua_globals,lua_whitelist
-    if not has_lua:
-        raise NotImplementedError("lupa module not loaded")
+    lua,lua_globals=parser.lua
     if reset:
         for k in lua_globals:
             if k in lua_whitelist:
@@ -1173,8 +1480,8 @@ def lua_eval(code,parser,*,reset=True,**kwargs):
         'atlas':to_id_map(Vessel.atlas),
         'spells':to_id_map(Vessel.spells),
         'tunnels':to_id_map(Vessel.tunnels),
-        'time':lua.table(Clock().as_dict()),
-        'nataniev':lambda tz:lua.table(Clock(tz).as_dict()),
+        'time':lua.table(Clock.get().as_dict()),
+        'nataniev':lambda tz:lua.table(Clock.get(tz).as_dict()),
         'find_vessel':lambda id_n:Vessel.find_distant(id_n),
     }
     g_upd.update(kwargs)
@@ -1221,9 +1528,22 @@ def init_lua():
     for k,v in lua_overrides.items():
         lua.execute("{}={}".format(k,v))
     return lua,lua_globals
+def test_failed_commit(parser):
+    "A command whose commit fails is rolled back and the next command still works"
+    from sqlalchemy import event
+    def fail(*args):
+        raise RuntimeError("forced flush failure")
+    event.listen(session,'before_flush',fail,once=True)
+    try:
+        parser.onecmd("!exec('Forum(host_id=self.location.id,from_id=self.location.id,message=\"doomed\")')")
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError("the commit did not fail")
+    parser.script("look")
+    assert not Forum.find(Forum.message=="doomed").count(),"the failed command was not rolled back"
+
 if __name__=="__main__":
-    if has_lua:
-        lua,lua_globals=init_lua()
     if args.test or args.do_import:
         import import_snapshot
     if args.empty:
@@ -1249,12 +1569,20 @@ if __name__=="__main__":
         #sys.stderr=open(os.devnull,"w")
         #stream=open(1,"w")
         args.no_interactive=True
+    if args.serve is not None:
+        if args.workers:
+            prefork(args.host,args.serve,args.workers)
+        else:
+            serve(args.host,args.serve)
+        sys.exit()
     if ((args.location is not None) and args.vessel):
         args.location=Vessel.get(args.location)
     parser=Cmd_Parser(args.location)
+    if import_profile:
+        import_profile.report()
     if args.json:
         import pprint
-        pprint.pprint((parser.vessel or parser.location).dict)
+        pprint.pprint(dict((parser.vessel or parser.location).dict))
         #print(serialize(parser.vessel or parser.location),file=stream)
     #exit()
     if args.commands:
@@ -1262,6 +1590,7 @@ if __name__=="__main__":
     if args.test:
         parser=Cmd_Parser(20)
         parser.vessel=None
+        test_failed_commit(parser)
         parser.script(
             "create a unit tester",
             "become a unit tester",
@@ -0,0 +1,99 @@
+import mmap
+import os
+import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from dateutil.parser import parse
+
+chunk_size=4*1024*1024
+fixed_date=re.compile("[0-9]{8}(?:[0-9]{4}(?:[0-9]{2})?)?$")
+
+def parse_date(value):
+    "Parse the YYYYMMDD[hhmm[ss]] timestamps of the snapshots directly, anything else goes through dateutil"
+    if fixed_date.match(value):
+        try:
+            return datetime(
+                int(value[0:4]),int(value[4:6]),int(value[6:8]),
+                int(value[8:10] or 0),int(value[10:12] or 0),int(value[12:14] or 0)
+            )
+        except ValueError:
+            pass
+    return parse(value)
+
+def header_slices(line):
+    "Column names and slices from an '@ ' header line"
+    value_slices=[]
+    line=line.strip("@ ")
+    first_word=line.split()[0]
+    line=line.replace(first_word,first_word+"  ")
+    for match in re.finditer(r"(\w+)\s*",line):
+        value_slices.append((match.groups()[0].lower(),list(match.span())))
+    value_slices[-1][1][1]=None
+    return [(k,slice(*v)) for k,v in value_slices]
+
+def _lines(mm,start,end):
+    mm.seek(start)
+    while mm.tell()<end:
+        line=mm.readline()
+        if not line:
+            break
+        yield str(line,"utf-8").rstrip("\r\n")
+
+def _find_header(mm):
+    for line in _lines(mm,0,len(mm)):
+        if line.startswith("@ "):
+            return header_slices(line),mm.tell()
+    return None,len(mm)
+
+def _parse_range(path,start,end,slices):
+    with open(path,"rb") as fh,mmap.mmap(fh.fileno(),0,access=mmap.ACCESS_READ) as mm:
+        for line in _lines(mm,start,end):
+            if not line.strip() or line.startswith("~"):
+                continue
+            yield tuple(line[v].strip() for v in slices)
+
+def _parse_chunk(path,start,end,slices):
+    return list(_parse_range(path,start,end,slices))
+
+def _chunks(mm,start,size):
+    while start<len(mm):
+        end=mm.find(b"\n",start+size)
+        end=len(mm) if end==-1 else end+1
+        yield start,end
+        start=end
+
+def memory_array_columns(path):
+    "Column names of a .ma file, in the order read_memory_array yields them"
+    if not os.path.getsize(path):
+        return []
+    with open(path,"rb") as fh,mmap.mmap(fh.fileno(),0,access=mmap.ACCESS_READ) as mm:
+        header,start=_find_header(mm)
+    return [k for k,v in header or ()]
+
+def read_memory_array(path,processes=1):
+    """Stream the rows of a .ma file as tuples ordered like memory_array_columns.
+    With processes>1 (None for one per CPU) files larger than a chunk are parsed across a process pool,
+    slicing is cheap enough that sending the rows back often costs as much as it saves."""
+    if not os.path.getsize(path):
+        return
+    with open(path,"rb") as fh,mmap.mmap(fh.fileno(),0,access=mmap.ACCESS_READ) as mm:
+        header,start=_find_header(mm)
+        if header is None:
+            return
+        slices=[v for k,v in header]
+        if processes is None:
+            processes=min(os.cpu_count() or 1,(len(mm)-start)//chunk_size)
+        if processes<=1:
+            yield from _parse_range(path,start,len(mm),slices)
+            return
+        chunks=list(_chunks(mm,start,chunk_size))
+    with ProcessPoolExecutor(processes) as pool:
+        # only keep a few chunks in flight so memory doesn't grow with the file
+        pending=deque()
+        for chunk_start,chunk_end in chunks:
+            pending.append(pool.submit(_parse_chunk,path,chunk_start,chunk_end,slices))
+            if len(pending)>processes:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
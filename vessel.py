@@ -1,18 +1,27 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect
 from sqlalchemy.orm import relationship, backref, validates
-from sqlalchemy.orm import sessionmaker,scoped_session
+from sqlalchemy.orm.util import identity_key
+from sqlalchemy.pool import NullPool
+from sqlalchemy.orm import sessionmaker,scoped_session,Session
 from sqlalchemy.schema import ForeignKey
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy import Column, Integer, String, DateTime, Boolean
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, Index
 import sqlalchemy.exc
 from datetime import datetime
+import re
 import random
 import jinja2
 import os
 from date_time import Clock
 import hashlib
 import binascii
+import threading
+from collections import defaultdict,OrderedDict
+from itertools import islice
+from collections.abc import Mapping,MutableSet,Sequence
+from contextlib import contextmanager
+from aho_corasick import Automaton
 
 import traceback
 
@@ -48,8 +57,93 @@ def split_vessel_name(value):
         return attr,name
     return "",""
 Base = declarative_base()
-engine = create_engine('sqlite:///universe.db', echo=False)
-session = scoped_session(sessionmaker(bind=engine))
+# one persistent connection per thread, so PRAGMA data_version can tell us about writes from other processes
+# server threads close theirs with release_connection()
+engine = create_engine('sqlite:///universe.db', echo=False, poolclass=NullPool)
+threads=threading.local()
+def thread_connection():
+    "The calling thread's connection, opened on first use"
+    connection=getattr(threads,"connection",None)
+    if connection is None or connection.closed:
+        connection=threads.connection=engine.connect()
+    return connection
+class ThreadSession(Session):
+    "Session bound to the connection of the thread that created it"
+    def __init__(self,**kwargs):
+        kwargs["bind"]=thread_connection()
+        super().__init__(**kwargs)
+session = scoped_session(sessionmaker(class_=ThreadSession))
+pragmas=OrderedDict([
+    ("journal_mode","WAL"), # readers don't block the writer, commits append to the log
+    ("synchronous","NORMAL"), # WAL stays consistent, only the last commits can be lost on power failure
+    ("mmap_size",256*1024*1024),
+    ("cache_size",-64*1024), # KiB
+    ("busy_timeout",5000), # ms, other workers may be holding the write lock
+    ("foreign_keys","OFF"), # imported snapshots reference vessels that no longer exist
+])
+
+@event.listens_for(engine,'connect')
+def _set_pragmas(connection,record):
+    cursor=connection.cursor()
+    for key,value in pragmas.items():
+        cursor.execute("PRAGMA {}={}".format(key,value))
+    cursor.close()
+
+def release_connection():
+    "Close the calling thread's session and connection"
+    session.remove()
+    # data_version can only be compared on the same connection
+    index.connection.data_version=None
+    connection=getattr(threads,"connection",None)
+    if connection is not None:
+        del threads.connection
+        connection.close()
+
+# every insert, update and delete of a vessel is logged, so other connections can refresh just those vessels
+# a vessel_id of -1 tells them to reload everything, after the table was dropped or bulk loaded
+change_log=[
+    "CREATE TABLE IF NOT EXISTS vessel_changes (seq INTEGER PRIMARY KEY AUTOINCREMENT, vessel_id INTEGER NOT NULL)",
+    "CREATE TRIGGER IF NOT EXISTS vessels_insert_log AFTER INSERT ON vessels BEGIN INSERT INTO vessel_changes (vessel_id) VALUES (NEW.id); END",
+    "CREATE TRIGGER IF NOT EXISTS vessels_update_log AFTER UPDATE ON vessels BEGIN INSERT INTO vessel_changes (vessel_id) SELECT NEW.id UNION SELECT OLD.id; END",
+    "CREATE TRIGGER IF NOT EXISTS vessels_delete_log AFTER DELETE ON vessels BEGIN INSERT INTO vessel_changes (vessel_id) VALUES (OLD.id); END",
+    # readers further behind than this reload the whole index
+    "CREATE TRIGGER IF NOT EXISTS vessel_changes_prune AFTER INSERT ON vessel_changes WHEN NEW.seq%1000=0 BEGIN DELETE FROM vessel_changes WHERE seq<=NEW.seq-10000; END",
+]
+
+change_log_triggers=("vessels_insert_log","vessels_update_log","vessels_delete_log")
+
+def _create_change_log(target,connection,**kwargs):
+    for statement in change_log:
+        connection.execute(statement)
+
+def _log_reset(target,connection,**kwargs):
+    connection.execute(change_log[0])
+    connection.execute("INSERT INTO vessel_changes (vessel_id) VALUES (-1)")
+
+@contextmanager
+def unlogged():
+    "Bulk write vessels without logging each one, other connections reload their whole index afterwards"
+    with transaction():
+        for name in change_log_triggers:
+            session.execute("DROP TRIGGER IF EXISTS {}".format(name))
+        yield
+        _create_change_log(None,session)
+        _log_reset(None,session)
+
+def migrate():
+    "Create indexes and the change log missing from databases made by older versions"
+    inspector=inspect(engine)
+    tables=inspector.get_table_names()
+    if "vessels" in tables:
+        with engine.begin() as connection:
+            _create_change_log(None,connection)
+    for table in Base.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing={ix['name'] for ix in inspector.get_indexes(table.name)}
+        for ix in table.indexes:
+            if ix.name not in existing:
+                ix.create(engine)
 
 class ClassProperty(property):
     def __get__(self, cls, owner):
@@ -103,31 +197,74 @@ class Forum(Base):
     from_id = Column(Integer,ForeignKey('vessels.id'))
     message = Column(String,nullable=False)
     timestamp_raw = Column(DateTime,nullable=True,default=datetime.now,)
+    __table_args__ = (Index('ix_forum_host_id_id','host_id','id'),)
     def __init__(self,*args,**kwargs):
         super().__init__(*args,**kwargs)
         session.add(self)
     
-    @validates("host_id")
-    def validate_host_id(self,key,host_id):
-        assert Vessel.exists(Vessel.id==host_id),"Container vessel for message does not exist"
-        return host_id
+    missing={
+        "host_id":"Container vessel for message does not exist",
+        "from_id":"Source vessel for message does not exist",
+    }
+    
+    @validates("host_id","from_id")
+    def validate_vessel_id(self,key,id_n):
+        assert index.contains(id_n),Forum.missing[key]
+        return id_n
+    
+    @classmethod
+    def post_many(cls,records):
+        "Add messages from dicts, returns the posted messages and (record,reason) for rejected ones"
+        posted,rejected=[],[]
+        for record in records:
+            try:
+                posted.append(cls(**record))
+            except AssertionError as e:
+                rejected.append((record,str(e)))
+        return posted,rejected
+    
+    @classmethod
+    def load_many(cls,records,batch_size=5000,vessel_ids=None):
+        """Bulk insert message dicts in one transaction without going through the ORM, returns the number loaded and (record,reason) for rejected ones.
+        Host and sender are checked against vessel_ids if given, instead of loading the index."""
+        contains=index.contains if vessel_ids is None else vessel_ids.__contains__
+        rejected=[]
+        def accepted():
+            for record in records:
+                for key,reason in cls.missing.items():
+                    if not contains(record[key]):
+                        rejected.append((record,reason))
+                        break
+                else:
+                    yield record
+        return insert_many(cls,accepted(),batch_size),rejected
     
-    @validates("from_id")
-    def validate_from_id(self,key,from_id):
-        assert Vessel.exists(Vessel.id==from_id),"Source vessel for message does not exist"
-        return from_id
+    @classmethod
+    def post(cls,**record):
+        posted,rejected=cls.post_many([record])
+        if rejected:
+            raise AssertionError(rejected[0][1])
+        return posted[0]
     
     def commit(self):
-        return session.commit()
+        return commit_or_flush()
     
     @classmethod
     def update(self):
-        return session.commit()
+        return commit_or_flush()
     
     @classmethod
     def find(cls,*args,**kwargs):
         return session.query(cls).filter(*args,**kwargs)
     
+    @classmethod
+    def tail(cls,host_id,limit=None,before=None):
+        "Last messages in a host (optionally older than message id before), oldest first"
+        query=cls.find(cls.host_id==host_id)
+        if before is not None:
+            query=query.filter(cls.id<before)
+        return query.order_by(cls.id.desc()).limit(limit).all()[::-1]
+    
     @property
     def from_vessel(self):
         return Vessel.get(self.from_id)
@@ -138,7 +275,7 @@ class Forum(Base):
     
     @property
     def timestamp(self):
-        return Clock().to_str(self.timestamp_raw)
+        return Clock.get().to_str(self.timestamp_raw)
     
     @timestamp.setter
     def set_timestamp(self,value):
@@ -147,57 +284,101 @@ class Forum(Base):
     
     @property
     def dict(self):
-        ret={c.name: getattr(self, c.name) for c in self.__table__.columns}
-        ret['host_vessel']=self.host_vessel
-        ret['from_vessel']=self.from_vessel
-        ret['rendered']=self.str
+        return Forum.dicts([self])[0]
+    
+    @classmethod
+    def dicts(cls,messages):
+        vessels=cls.prefetch(messages)
+        ret=[]
+        for message,rendered in zip(messages,cls.render_many(messages,vessels)):
+            row={c.name: getattr(message, c.name) for c in cls.__table__.columns}
+            row['host_vessel']=vessels.get(message.host_id)
+            row['from_vessel']=vessels.get(message.from_id)
+            row['rendered']=rendered
+            ret.append(row)
+        return ret
+    
+    @classmethod
+    def prefetch(cls,messages):
+        # every vessel the messages refer to, in one query
+        ids=set()
+        for message in messages:
+            ids.update(message.refs())
+            ids.add(message.host_id)
+        ids.discard(None)
+        return {vessel.id:vessel for vessel in Vessel.get_many(sorted(ids))}
+    
+    @classmethod
+    def render_many(cls,messages,vessels=None):
+        "Rendered lines for messages, cached until a vessel they mention changes"
+        cache=index.ensure().messages
+        keys=[tuple(index.versions[i] for i in m.refs()) for m in messages]
+        # look entries up once, storing the missing ones may evict others
+        entries=[cache.get(m.id) for m in messages]
+        missing=[m for m,key,cached in zip(messages,keys,entries) if cached is None or cached[0]!=key]
+        if missing and vessels is None:
+            vessels=cls.prefetch(missing)
+        timestamps=dict(zip(missing,Clock.get().to_str_many([m.timestamp_raw for m in missing]))) if missing else {}
+        ret=[]
+        for message,key,cached in zip(messages,keys,entries):
+            if cached is None or cached[0]!=key:
+                cached=(key,message.render(timestamps[message],vessels))
+                if message.id is not None:
+                    cache[message.id]=cached
+            ret.append(cached[1])
         return ret
     
+    def refs(self):
+        if self.message and self.message.isnumeric():
+            return (self.from_id,int(self.message))
+        return (self.from_id,)
+    
     def __repr__(self):
         return '<Message from {} in {}>'.format(self.from_vessel.full_name_with_id,self.host_vessel.full_name_with_id)
     
     @property
     def str(self):
+        return Forum.render_many([self])[0]
+    
+    def render(self,timestamp,vessels):
         if not self.message:
             return None
+        from_vessel=vessels.get(self.from_id)
         if self.message.startswith("me "):
-            ret="[{}] The {} {}".format(self.timestamp,self.from_vessel.full_name_with_id,self.message[3:])
+            ret="[{}] The {} {}".format(timestamp,from_vessel.full_name_with_id,self.message[3:])
         elif self.message.split()[0].lower() in question_words:
-            ret="[{}] The {} asked '{}?'".format(self.timestamp,self.from_vessel.full_name_with_id,self.message.rstrip('?'))
+            ret="[{}] The {} asked '{}?'".format(timestamp,from_vessel.full_name_with_id,self.message.rstrip('?'))
         elif self.message.endswith("?"):
-            ret="[{}] The {} asked '{}?'".format(self.timestamp,self.from_vessel.full_name_with_id,self.message.rstrip('?'))
+            ret="[{}] The {} asked '{}?'".format(timestamp,from_vessel.full_name_with_id,self.message.rstrip('?'))
         elif self.message.endswith("!"):
-            ret="[{}] The {} shouted '{}!'".format(self.timestamp,self.from_vessel.full_name_with_id,self.message.rstrip('!'))
+            ret="[{}] The {} shouted '{}!'".format(timestamp,from_vessel.full_name_with_id,self.message.rstrip('!'))
         elif self.message.isnumeric():
-            try:
-                msg_vessel=Vessel.get(int(self.message))
-            except:
-                msg_vessel=None
+            msg_vessel=vessels.get(int(self.message))
             if msg_vessel:
-                ret="[{}] The {} indicated the {}".format(self.timestamp,self.from_vessel.full_name_with_id,msg_vessel.full_name_with_id)
+                ret="[{}] The {} indicated the {}".format(timestamp,from_vessel.full_name_with_id,msg_vessel.full_name_with_id)
             else:
-                ret="[{}] The {} said '{}.'".format(self.timestamp,self.from_vessel.full_name_with_id,self.message.rstrip('.'))
+                ret="[{}] The {} said '{}.'".format(timestamp,from_vessel.full_name_with_id,self.message.rstrip('.'))
         else:
-            ret="[{}] The {} said '{}.'".format(self.timestamp,self.from_vessel.full_name_with_id,self.message.rstrip('.'))
+            ret="[{}] The {} said '{}.'".format(timestamp,from_vessel.full_name_with_id,self.message.rstrip('.'))
         return ret
         
 class Vessel(Base):
     __tablename__ = "vessels"
     id = Column(Integer,primary_key=True)
-    name = Column(String)
+    name = Column(String,index=True)
     attr = Column(String,default="")
     raw_note = Column(String,default="")
     program = Column(String,default="")
     
-    parent_id = Column(Integer,ForeignKey('vessels.id'),default=None)
+    parent_id = Column(Integer,ForeignKey('vessels.id'),default=None,index=True)
     _children_ = relationship("Vessel",primaryjoin =('Vessel.id == Vessel.parent_id'),backref=backref('parent', remote_side=[id]),post_update=True)
-    owner_id = Column(Integer,ForeignKey('vessels.id'),default=None)
+    owner_id = Column(Integer,ForeignKey('vessels.id'),default=None,index=True)
     owned = relationship("Vessel",primaryjoin =('Vessel.id == Vessel.owner_id'),backref=backref('owner', remote_side=[id]),post_update=True)
     created_raw = Column("created",DateTime,nullable=True,default=datetime.now)
     locked = Column(Boolean,default=False)
     hidden = Column(Boolean,default=False)
     silent = Column(Boolean,default=False)
-    tunnel = Column(Boolean,default=False)
+    tunnel = Column(Boolean,default=False,index=True)
     
     def __init__(self,*args,**kwargs):
         if len(args)==1:
@@ -218,6 +399,23 @@ class Vessel(Base):
         assert 2<len(value)<16,"Vessel {} has to be between 3 and 15 characters".format(key.replace("attr","attribute"))
         return value
     
+    @classmethod
+    def load_many(cls,records,batch_size=5000):
+        "Bulk insert vessel dicts in one transaction without going through the ORM, returns the number loaded and (record,reason) for rejected ones"
+        rejected=[]
+        def accepted():
+            for record in records:
+                try:
+                    for key in ("name","attr"):
+                        if key in record:
+                            cls.__check(None,key,record[key])
+                except AssertionError as e:
+                    rejected.append((record,str(e)))
+                    continue
+                yield record
+        with unlogged():
+            return insert_many(cls,accepted(),batch_size),rejected
+    
     @property
     def has_errors(self):
         checks=[
@@ -226,17 +424,16 @@ class Vessel(Base):
         return [msg for c,msg in checks if not c]
     
     def commit(self):
-        session.commit()
+        session.flush()
         if self.parent_id==None:
             self.parent_id=self.id
-            session.commit()
         if self.owner_id==None:
             self.owner_id=self.parent_id
-            session.commit()
+        commit_or_flush()
     
     @property
     def created(self):
-        return Clock().to_str(self.created_raw)
+        return Clock.get().to_str(self.created_raw)
     
     @created.setter
     def set_created(self,value):
@@ -244,37 +441,20 @@ class Vessel(Base):
     
     @classmethod
     def update(self):
-        return session.commit()
+        return commit_or_flush()
     
     @property
     def forum(self):
+        return self.messages()
+    
+    def messages(self,limit=None,before=None):
         if self.silent:
             return []
-        return [r.dict for r in Forum.find(Forum.host_id==self.id).all()]
+        return Forum.dicts(Forum.tail(self.id,limit,before))
     
     @property
     def note(self):
-        tagged=[]
-        note=self.raw_note
-        for vessel in self.find(Vessel.tunnel==True):
-            if vessel.id in tagged:
-                continue
-            tagged.append(vessel.id)
-            template="|{}|"
-            if vessel.program:
-                template="^"+template
-            if len(vessel.full_name)>2:
-                note=note.replace(vessel.full_name,template.format(vessel.full_name))
-        for vessel in self.visible:
-            if vessel.id in tagged:
-                continue
-            tagged.append(vessel.id)
-            template="[{}]"
-            if vessel.program:
-                template="^"+template
-            if len(vessel.full_name)>2:
-                note=note.replace(vessel.full_name,template.format(vessel.full_name))
-        return note
+        return index.render_note(self,self.raw_note)
     
     @note.setter
     def set_note(self,value):
@@ -282,90 +462,36 @@ class Vessel(Base):
     
     @property
     def children(self):
-        #print("C")
-        #traceback.print_stack()
-        query=(
-            (Vessel.parent_id==self.id) & \
-            (Vessel.id != self.id) & \
-            (Vessel.name!="")
-        )
-        if self.silent:
-            return Vessel.find(query).filter((Vessel.owner_id == self.owner_id) | (Vessel.owner_id == self.id))
-        else:
-            return Vessel.find(query)
+        return Vessel.get_many(sorted(index.children_of(self)))
     
     @property
     def siblings(self):
-        #print("S")
-        #traceback.print_stack()
-        query=(
-            (Vessel.parent_id==self.parent_id) & \
-            (Vessel.id != self.parent_id) & \
-            (Vessel.id != self.id) & \
-            (Vessel.name!="")
-        )
-        if self.silent:
-            return Vessel.find(query).filter((Vessel.owner_id == self.owner_id) | (Vessel.owner_id == self.id))
-        else:
-            return Vessel.find(query)
+        return Vessel.get_many(sorted(index.siblings_of(self)))
     
     @property
     def visible(self):
-        ret=[]
-        for v in self.siblings.all()+self.children.all():
-            if v in ret:
-                continue
-            ret.append(v)
-        return ret
+        return Vessel.get_many(index.visible_of(self))
     
     def find_visible(self,name):
         if not name:
             return None
-        if name.isnumeric():
-            name=int(name)
-        tunnel_list=Vessel.find(Vessel.tunnel==True).all()
-        tunnels=[]
-        for tunnel in tunnel_list:
-            if tunnel.full_name.strip():
-                if self.raw_note.lower().find(tunnel.full_name.lower())!=-1:
-                    tunnels.append(tunnel)
+        candidates=index.visible_of(self)+sorted(index.tunnel_matcher().find(self.raw_note.lower()))
         if self.tunnel:
-            tunnels+=Vessel.tunnels()
-        visible=self.visible+tunnels
-        if isinstance(name,int):
-            for vessel in visible:
-                if vessel.id==name:
-                    return vessel
+            candidates+=index.tunnel_note_ids()
+        if name.isnumeric():
+            if int(name) in candidates:
+                return Vessel.get(int(name))
             return
-        attr,name=split_vessel_name(name.lower())
-        for vessel in visible:
-            if vessel.name.lower()==name and vessel.attr.lower()==attr:
-                return vessel
-        for vessel in visible:
-            if vessel.name.lower()==name:
-                return vessel
-        for vessel in visible:
-            if vessel.attr.lower()==name:
-                return vessel
+        id_n=index.resolve(name,candidates)
+        if id_n is not None:
+            return Vessel.get(id_n)
 
     def find_child(self,name):
         if not name:
             return None
-        children=self.children
-        attr,name=split_vessel_name(name.lower())
-        for vessel in children:
-            if vessel.name.lower()==name and vessel.attr.lower()==attr:
-                if vessel.parent.silent:
-                    continue
-                return vessel
-        for vessel in children:
-            if vessel.name.lower()==name:
-                if vessel.parent.silent:
-                    continue
-                return vessel
-        for vessel in children:
-            if vessel.attr.lower()==name:
-                return vessel
+        id_n=index.resolve(name,sorted(index.children_of(self)),attr_only=self.silent)
+        if id_n is not None:
+            return Vessel.get(id_n)
 
     @classmethod
     def find_random(cls):
@@ -379,41 +505,26 @@ class Vessel(Base):
             return cls.get(int(name))
         except ValueError:
             pass
-        vessels=cls.find().all()
-        attr,name=split_vessel_name(name.lower())
-        for vessel in vessels:
-            if vessel.name.lower()==name and vessel.attr.lower()==attr:
-                return vessel
-        for vessel in vessels:
-            if vessel.name.lower()==name:
-                return vessel
-        for vessel in vessels:
-            if vessel.attr.lower()==name:
-                return vessel
+        id_n=index.resolve(name)
+        if id_n is not None:
+            return cls.get(id_n)
     
     @classmethod
     def random(cls,*query_t,num=1):
-        if not query_t:
-            query_t=(Vessel,)
-        cnt=session.query(Vessel).count()
-        if not cnt:
+        ids=index.ensure().ids
+        if not ids:
             return Ghost()
-        res=[]
-        while len(res)!=num:
-            id_n=random.choice(range(cnt))
-            V=Vessel.get(id_n)
-            if V is not None:
-                res.append(V)
-        if len(res)==1:
+        res=cls.get_many(ids.sample(num))
+        if num==1:
             return res[0]
         return res
     
     def random_child(self,num=1):
-        if not self.children.count():
+        res=Vessel.get_many(index.sample_children(self,num))
+        if not res:
             return None
-        res=random.sample(self.children.all(),num)
         if num==1:
-            return res and res[0]
+            return res[0]
         return res
     
     def __repr__(self):
@@ -425,25 +536,12 @@ class Vessel(Base):
     
     @property
     def dict(self):
-        cols=self.cols.copy()
-        cols['parent']=self.parent
-        cols['owner']=self.owner
-        cols['children']=self.children.all()
-        cols['num_children']=len(cols['children'])
-        cols['siblings']=self.siblings.all()
-        cols['num_siblings']=len(cols['siblings'])
-        cols['visible']=self.visible
-        cols['num_visible']=len(cols['visible'])
-        cols['stem']=self.stem
-        cols['paradox']=self.paradox
-        cols['depth']=self.depth
-        cols['rating']=self.rating
-        cols['full_name']=self.full_name
-        cols['full_name_with_id']=self.full_name_with_id
-        cols['random']=self.random()
-        cols['random_child']=self.random_child()
-        cols['forum']=self.forum
-        return cols
+        memo=getattr(_render,"memo",None)
+        if memo is None:
+            return VesselDict(self)
+        if self not in memo:
+            memo[self]=VesselDict(self)
+        return memo[self]
     
     @property
     def full_name(self):
@@ -455,18 +553,7 @@ class Vessel(Base):
     
     @property
     def rating(self):
-        values=[
-            self.raw_note.strip()!="",
-            self.attr.strip()!="",
-            self.program.strip()!="",
-            self.children.count(),
-            self.paradox,
-            self.locked,
-            self.hidden,
-            self.silent,
-            self.tunnel,
-        ]
-        return int((sum(map(bool,values))/len(values))*100)
+        return index.rating_of(self)
     
     def __getitem__(self,name):
         try:
@@ -485,38 +572,51 @@ class Vessel(Base):
         except TypeError:
             return None
     
+    @classmethod
+    def get_many(cls,ids):
+        ids=list(ids)
+        found={}
+        missing=[]
+        for id_n in ids:
+            vessel=session.identity_map.get(identity_key(cls,id_n))
+            if vessel is None or inspect(vessel).expired:
+                missing.append(id_n)
+            else:
+                found[id_n]=vessel
+        for n in range(0,len(missing),500):
+            for vessel in cls.find(cls.id.in_(missing[n:n+500])).all():
+                found[vessel.id]=vessel
+        return [found[id_n] for id_n in ids if id_n in found]
+    
+    @classmethod
+    def sync(cls):
+        # data_version is per connection, and so per thread, and doesn't change for this connection's own commits
+        # commits from other threads of this process show up too, refreshing their logged vessels again is cheap
+        version=session.execute("PRAGMA data_version").scalar()
+        if version!=getattr(index.connection,"data_version",None):
+            index.refresh()
+            index.connection.data_version=version
+    
     @ClassProperty
     @classmethod
     def atlas(cls):
-        ret=[]
-        for vessel in cls.find(cls.id==cls.parent_id).all():
-            if any([
-                not vessel.locked,
-                vessel.hidden,
-                vessel.rating<50,
-                vessel.id<1,
-            ]):
-                continue
-            ret.append(vessel)
-        return ret
+        return cls.get_many(index.atlas_ids())
     
     @ClassProperty
     @classmethod
     def tunnels(cls):
-        ret=[]
-        tunnel_list=cls.find(cls.tunnel==True).all()
-        for vessel in cls.find(cls.hidden==False).filter(cls.locked==True).all():
-            for tunnel in tunnel_list:
-                if tunnel.full_name.strip():
-                    if vessel.raw_note.lower().find(tunnel.full_name.lower())!=-1:
-                        ret.append(vessel)
-                        break
-        return ret
+        return cls.get_many(index.tunnel_note_ids())
     
     @ClassProperty
     @classmethod
     def spells(cls):
-        return cls.find(cls.name=="spell").filter(cls.program!="").filter(cls.locked==True).filter(cls.attr!="").all()
+        return cls.get_many(sorted(index.ensure().spells))
+    
+    @classmethod
+    def find_spell(cls,full_name):
+        ids=index.ensure().spell_names.get(full_name)
+        if ids:
+            return cls.get(min(ids))
     
     @ClassProperty
     @classmethod
@@ -530,47 +630,679 @@ class Vessel(Base):
     
     @property
     def stem(self):
-        V=self
-        L=[]
-        while 1:
-            L.append(V.id)
-            if V.parent is None:
-                break
-            V=V.parent
-            if V.parent_id==V.id:
-                return V
-            if V.id in L:
-                return V
-        return V
+        stem_id,depth=index.ancestry_of(self)
+        if stem_id is None:
+            return self
+        return Vessel.get(stem_id)
     
     def __setattr__(self,name,value):
-        #print("Set",name,value)
-        try:
-            if name in self.dict:
-                if self.locked and name!="locked":
-                    print("The {} is locked and may not be modified".format(self.full_name_with_id))
-                    return
-        except AttributeError:
-            pass
+        if name in Vessel.guarded:
+            if name!="locked" and self.is_locked:
+                print("The {} is locked and may not be modified".format(self.full_name_with_id))
+                return
         return super().__setattr__(name,value)
     
+    @property
+    def is_locked(self):
+        # vessels under construction are never locked, the constructor may pass locked before other columns
+        id_n=_vessel_id(self)
+        if id_n is None:
+            return False
+        if index.loaded and id_n in index.rows:
+            return index.rows[id_n]['locked']
+        return self.locked
+    
     @property
     def depth(self):
-        V=self
-        L=[]
-        d=0
+        return index.ancestry_of(self)[1]
+    
+    @classmethod
+    def exists(cls,*args,**kwargs):
+        return session.query(session.query(cls).exists().where(*args,**kwargs)).scalar()
+
+def _column_getter(name):
+    return lambda d:getattr(d.vessel,name)
+
+class VesselDict(Mapping):
+    "Read-only view of a vessel's template variables, computing each key on first access"
+    fields=OrderedDict((c.name,_column_getter(c.name)) for c in Vessel.__table__.columns)
+    fields.update([
+        ('parent',lambda d:d.vessel.parent),
+        ('owner',lambda d:d.vessel.owner),
+        ('children',lambda d:VesselList(sorted(index.children_of(d.vessel)))),
+        ('num_children',lambda d:len(d['children'])),
+        ('siblings',lambda d:VesselList(sorted(index.siblings_of(d.vessel)))),
+        ('num_siblings',lambda d:len(d['siblings'])),
+        ('visible',lambda d:VesselList(index.visible_of(d.vessel))),
+        ('num_visible',lambda d:len(d['visible'])),
+        ('stem',lambda d:d.vessel.stem),
+        ('paradox',lambda d:d.vessel.paradox),
+        ('depth',lambda d:d.vessel.depth),
+        ('rating',lambda d:d.vessel.rating),
+        ('full_name',lambda d:d.vessel.full_name),
+        ('full_name_with_id',lambda d:d.vessel.full_name_with_id),
+        ('random',lambda d:d.vessel.random()),
+        ('random_child',lambda d:d.vessel.random_child()),
+        ('forum',lambda d:d.vessel.forum),
+    ])
+    def __init__(self,vessel):
+        self.vessel=vessel
+        self.cache={}
+    
+    def __getitem__(self,key):
+        if key not in self.cache:
+            self.cache[key]=self.fields[key](self)
+        return self.cache[key]
+    
+    def __contains__(self,key):
+        return key in self.fields
+    
+    def __iter__(self):
+        return iter(self.fields)
+    
+    def __len__(self):
+        return len(self.fields)
+
+class VesselList(Sequence):
+    "Sequence of vessels by id, loading only the items that are accessed"
+    def __init__(self,ids):
+        self.ids=ids
+    
+    def __getitem__(self,key):
+        if isinstance(key,slice):
+            return Vessel.get_many(self.ids[key])
+        return Vessel.get(self.ids[key])
+    
+    def __iter__(self):
+        for n in range(0,len(self.ids),100):
+            yield from Vessel.get_many(self.ids[n:n+100])
+    
+    def __len__(self):
+        return len(self.ids)
+
+    # behave like the lists these used to be in templates, e.g. (vessel.children+vessel.siblings)|length
+    def __add__(self,other):
+        return list(self)+list(other)
+
+    def __radd__(self,other):
+        return list(other)+list(self)
+
+    def __eq__(self,other):
+        if isinstance(other,VesselList):
+            return self.ids==other.ids
+        if isinstance(other,Sequence) and not isinstance(other,str):
+            return len(self)==len(other) and list(self)==list(other)
+        return NotImplemented
+
+    __hash__=None
+
+    def __repr__(self):
+        return repr(list(self))
+
+Vessel.guarded=frozenset(inspect(Vessel).attrs.keys())
+
+_render=threading.local()
+
+@contextmanager
+def render_scope():
+    "Memoize Vessel.dict lookups until the outermost scope exits"
+    if getattr(_render,"memo",None) is not None:
+        yield
+        return
+    _render.memo={}
+    try:
+        yield
+    finally:
+        _render.memo=None
+
+_transaction=threading.local()
+
+@contextmanager
+def transaction():
+    "Run the block as one transaction, committing when the outermost scope exits without an error and rolling back otherwise"
+    depth=getattr(_transaction,"depth",0)
+    _transaction.depth=depth+1
+    try:
+        yield
+        if not depth:
+            session.commit()
+    except:
+        # also covers the commit, whose flush can still fail, e.g. with "database is locked"
+        if not depth:
+            session.rollback()
+        raise
+    finally:
+        _transaction.depth=depth
+
+def commit_or_flush():
+    # inside a transaction() the outermost scope commits, changes only need to reach the database
+    if getattr(_transaction,"depth",0):
+        return session.flush()
+    return session.commit()
+
+def insert_many(cls,records,batch_size=5000):
+    # executemany straight into the table, skips validators, mapper events and the index, so the index is rebuilt afterwards
+    # records can be any iterable, only one batch of rows is kept in memory
+    columns={prop.key:prop.columns[0].key for prop in cls.__mapper__.column_attrs}
+    defaults={col.key:col.default for col in cls.__table__.columns if col.default is not None}
+    def row(record):
+        row={columns[k]:v for k,v in record.items()}
+        # like the ORM, None falls back to the column default
+        for key,default in defaults.items():
+            if key in row and row[key] is None:
+                row[key]=default.arg(None) if default.is_callable else default.arg
+        return row
+    records=iter(records)
+    count=0
+    with transaction():
         while 1:
-            if V is None:
+            rows=[row(record) for record in islice(records,batch_size)]
+            if not rows:
                 break
-            if V.id in L:
+            session.execute(cls.__table__.insert(),rows)
+            count+=len(rows)
+    index.reset()
+    return count
+
+class LRUDict(OrderedDict):
+    "Dict that keeps only its maxsize most recently used entries"
+    def __init__(self,maxsize):
+        super().__init__()
+        self.maxsize=maxsize
+    
+    def get(self,key,default=None):
+        if key not in self:
+            return default
+        self.move_to_end(key)
+        return self[key]
+    
+    def __setitem__(self,key,value):
+        super().__setitem__(key,value)
+        self.move_to_end(key)
+        if len(self)>self.maxsize:
+            self.popitem(last=False)
+
+class IdPool(MutableSet):
+    "Set of ids kept in a dense list as well, for constant-time uniform sampling"
+    def __init__(self,ids=()):
+        self.items=[]
+        self.pos={}
+        for id_n in ids:
+            self.add(id_n)
+    
+    @classmethod
+    def _from_iterable(cls,it):
+        return set(it)
+    
+    def add(self,id_n):
+        if id_n not in self.pos:
+            self.pos[id_n]=len(self.items)
+            self.items.append(id_n)
+    
+    def discard(self,id_n):
+        n=self.pos.pop(id_n,None)
+        if n is None:
+            return
+        last=self.items.pop()
+        if n<len(self.items):
+            self.items[n]=last
+            self.pos[last]=n
+    
+    def __contains__(self,id_n):
+        return id_n in self.pos
+    
+    def __iter__(self):
+        return iter(self.items)
+    
+    def __len__(self):
+        return len(self.items)
+    
+    def choice(self):
+        return self.items[random.randrange(len(self.items))]
+    
+    def sample(self,num):
+        return random.sample(self.items,min(num,len(self.items)))
+
+class VesselIndex(object):
+    columns=("parent_id","owner_id","attr","name","program","locked","hidden","silent","tunnel")
+    def __init__(self):
+        self.loaded=False
+        self.connection=threading.local()
+        self.matcher=None
+        self.tunnel_notes=None
+        self.tunnel_version=0
+    
+    def reset(self,*args,**kwargs):
+        self.loaded=False
+        self.tunnels_changed()
+    
+    def tunnels_changed(self):
+        self.matcher=None
+        self.tunnel_notes=None
+        self.tunnel_version+=1
+    
+    def load(self):
+        self.rows={}
+        self.ids=IdPool()
+        self.children=defaultdict(IdPool)
+        self.owned=defaultdict(set)
+        self.ancestry={}
+        self.versions=defaultdict(int)
+        self.notes=LRUDict(4096)
+        self.names=defaultdict(set)
+        self.paradoxes=set()
+        self.spells={}
+        self.spell_names=defaultdict(set)
+        self.ratings={}
+        self.spawns=IdPool()
+        self.respawn=set()
+        self.messages=LRUDict(16384)
+        self.note_hashes={}
+        self.loaded=True
+        # read before the rows, changes in between are applied again by the next refresh
+        self.change_seq=session.execute("SELECT max(seq) FROM vessel_changes").scalar() or 0
+        for id_n,note,row in self._query():
+            self.note_hashes[id_n]=hash(note)
+            self._link(id_n,row)
+    
+    def _query(self,ids=None):
+        query=session.query(Vessel.id,Vessel.raw_note,*[getattr(Vessel,c) for c in self.columns])
+        if ids is not None:
+            query=query.filter(Vessel.id.in_(ids))
+        for id_n,note,*values in query:
+            row=dict(zip(self.columns,values))
+            row['has_note']=bool((note or "").strip())
+            yield id_n,note,row
+    
+    def refresh(self):
+        "Apply writes made through other connections, updating only the vessels listed in vessel_changes since the last load or refresh"
+        if not self.loaded:
+            return
+        first,last=session.execute("SELECT min(seq),max(seq) FROM vessel_changes").first()
+        if (last or 0)<self.change_seq or (first or 0)>self.change_seq+1:
+            # the log was recreated, or pruned past what we have seen
+            return self.reset()
+        if last is None or last==self.change_seq:
+            return
+        ids=[id_n for id_n, in session.execute(
+            "SELECT DISTINCT vessel_id FROM vessel_changes WHERE seq>:first AND seq<=:last",
+            {"first":self.change_seq,"last":last}
+        )]
+        if -1 in ids:
+            return self.reset()
+        self.change_seq=last
+        for start in range(0,len(ids),500):
+            self._refresh_ids(ids[start:start+500])
+    
+    def _refresh_ids(self,ids):
+        seen=set()
+        for id_n,note,row in self._query(ids):
+            seen.add(id_n)
+            old=self.rows.get(id_n)
+            if old is None:
+                self.insert(id_n,row)
+            else:
+                for key in self.columns:
+                    if old[key]!=row[key]:
+                        self.update(id_n,key,row[key])
+            if self.note_hashes.get(id_n)!=hash(note):
+                self.note_changed(id_n,note)
+        for id_n in set(ids)-seen:
+            self.remove(id_n)
+    
+    def ensure(self):
+        if session.new:
+            session.flush()
+        if not self.loaded:
+            self.load()
+        return self
+    
+    def insert(self,id_n,row):
+        self.remove(id_n)
+        self.invalidate_subtree(id_n)
+        self.versions[id_n]+=1
+        self._link(id_n,row)
+    
+    def _link(self,id_n,row):
+        if row['tunnel']:
+            self.tunnels_changed()
+        self.rows[id_n]=row
+        self.ids.add(id_n)
+        self.rerate(id_n)
+        self.respawn.update(self.children.get(id_n,()))
+        self.children[row['parent_id']].add(id_n)
+        self.owned[row['owner_id']].add(id_n)
+        for key in self._name_keys(row):
+            self.names[key].add(id_n)
+        self._classify(id_n)
+    
+    def _classify(self,id_n):
+        self.paradoxes.discard(id_n)
+        if id_n in self.spells:
+            self.spell_names[self.spells.pop(id_n)].discard(id_n)
+        row=self.rows.get(id_n)
+        if row is None:
+            return
+        if row['parent_id']==id_n:
+            self.paradoxes.add(id_n)
+        if row['name']=="spell" and row['program'] and row['locked'] and row['attr']:
+            self.spells[id_n]="{} {}".format(row['attr'],row['name']).strip()
+            self.spell_names[self.spells[id_n]].add(id_n)
+    
+    def _name_keys(self,row):
+        attr,name=(row['attr'] or "").lower(),(row['name'] or "").lower()
+        return (("attr_name",attr,name),("name",name),("attr",attr))
+    
+    def remove(self,id_n):
+        row=self.rows.pop(id_n,None)
+        if row is None:
+            return
+        self.note_hashes.pop(id_n,None)
+        if row['tunnel']:
+            self.tunnels_changed()
+        self.versions[id_n]+=1
+        self.ids.discard(id_n)
+        self.rerate(id_n,row)
+        self.respawn.update(self.children.get(id_n,()))
+        self.invalidate_subtree(id_n)
+        self.children[row['parent_id']].discard(id_n)
+        self.owned[row['owner_id']].discard(id_n)
+        for key in self._name_keys(row):
+            self.names[key].discard(id_n)
+        if self.tunnel_notes is not None:
+            self.tunnel_notes.discard(id_n)
+        self._classify(id_n)
+    
+    def update(self,id_n,key,value):
+        row=self.rows.get(id_n)
+        if row is None:
+            return
+        self.versions[id_n]+=1
+        self.rerate(id_n)
+        if key=="parent_id":
+            self.invalidate_subtree(id_n)
+            self.children[row['parent_id']].discard(id_n)
+            self.children[value].add(id_n)
+        elif key=="owner_id":
+            self.owned[row['owner_id']].discard(id_n)
+            self.owned[value].add(id_n)
+        elif key in ("attr","name"):
+            for name_key in self._name_keys(row):
+                self.names[name_key].discard(id_n)
+            for name_key in self._name_keys(dict(row,**{key:value})):
+                self.names[name_key].add(id_n)
+        if key=="tunnel" or (key in ("attr","name","program") and row['tunnel']):
+            self.tunnels_changed()
+        row[key]=value
+        self.rerate(id_n)
+        self._classify(id_n)
+    
+    def note_changed(self,id_n,note):
+        if id_n not in self.rows:
+            return
+        self.rows[id_n]['has_note']=bool((note or "").strip())
+        self.note_hashes[id_n]=hash(note)
+        self._dirty(id_n)
+        if self.tunnel_notes is None:
+            return
+        self.tunnel_notes.discard(id_n)
+        if self.matcher.search((note or "").lower()):
+            self.tunnel_notes.add(id_n)
+    
+    def invalidate_subtree(self,id_n):
+        todo=[id_n]
+        seen=set()
+        while todo:
+            id_n=todo.pop()
+            if id_n in seen:
+                continue
+            seen.add(id_n)
+            self.ancestry.pop(id_n,None)
+            todo.extend(self.children.get(id_n,()))
+    
+    def ancestry_of(self,vessel):
+        # (stem_id,depth), walking the parent chain only up to the first cached ancestor
+        self.ensure()
+        start=id_n=_vessel_id(vessel)
+        if id_n not in self.rows:
+            return None,0
+        path=[]
+        pos={}
+        while id_n not in self.ancestry:
+            parent_id=self.rows[id_n]['parent_id']
+            if parent_id==id_n:
+                self.ancestry[id_n]=(id_n,0)
                 break
-            L.append(V.id)
-            if V.parent_id==V.id:
+            if parent_id not in self.rows:
+                self.ancestry[id_n]=(id_n,1)
                 break
-            V=V.parent
-            d+=1
-        return d
+            pos[id_n]=len(path)
+            path.append(id_n)
+            if parent_id in pos:
+                cycle=path[pos[parent_id]:]
+                for n in cycle:
+                    self.ancestry[n]=(n,len(cycle))
+                del path[pos[parent_id]:]
+            id_n=parent_id
+        stem_id,depth=self.ancestry[id_n]
+        for n in reversed(path):
+            depth+=1
+            self.ancestry[n]=(stem_id,depth)
+        return self.ancestry[start]
     
-    @classmethod
-    def exists(cls,*args,**kwargs):
-        return session.query(session.query(cls).exists().where(*args,**kwargs)).scalar()
\ No newline at end of file
+    def contains(self,id_n):
+        # vessels that are not flushed yet are not indexed, flush them before giving up on an id
+        if not self.loaded:
+            self.load()
+        if id_n in self.ids:
+            return True
+        if session.new:
+            session.flush()
+        return id_n in self.ids
+    
+    def tunnel_matcher(self):
+        self.ensure()
+        if self.matcher is None:
+            self.tunnel_ids=sorted(id_n for id_n,row in self.rows.items() if row['tunnel'])
+            names=[]
+            for id_n in self.tunnel_ids:
+                row=self.rows[id_n]
+                names.append(("{} {}".format(row['attr'],row['name']).strip().lower(),id_n))
+            self.matcher=Automaton(names)
+        return self.matcher
+    
+    def tunnel_note_ids(self):
+        # ids of locked, non-hidden vessels whose note mentions a tunnel
+        matcher=self.tunnel_matcher()
+        if self.tunnel_notes is None:
+            self.tunnel_notes=set()
+            for id_n,note in session.query(Vessel.id,Vessel.raw_note):
+                if matcher.search((note or "").lower()):
+                    self.tunnel_notes.add(id_n)
+        return sorted(i for i in self.tunnel_notes if self.rows[i]['locked'] and not self.rows[i]['hidden'])
+    
+    def atlas_ids(self):
+        self.ensure()
+        return sorted(i for i in self.paradoxes if self.rows[i]['locked'] and not self.rows[i]['hidden'] and i>=1 and self.rating(i)>=50)
+    
+    def spawn_id(self):
+        "Random start location, rechecking only the vessels that changed since the last pick"
+        self.ensure()
+        for id_n in self.respawn:
+            if id_n in self.rows and self._spawnable(id_n):
+                self.spawns.add(id_n)
+            else:
+                self.spawns.discard(id_n)
+        self.respawn.clear()
+        if self.spawns:
+            return self.spawns.choice()
+    
+    def _spawnable(self,id_n):
+        # unlocked, visible vessels inside an existing parent with a rating of at least 50
+        row=self.rows[id_n]
+        return not (row['locked'] or row['hidden']) and id_n!=0 and row['parent_id'] in self.rows and self.rating(id_n)>=50
+    
+    def rerate(self,id_n,row=None):
+        # a rating depends on the vessel's own row and on whether it has visible children
+        row=row or self.rows.get(id_n)
+        self._dirty(id_n)
+        if row is not None:
+            self._dirty(row['parent_id'])
+    
+    def _dirty(self,id_n):
+        self.ratings.pop(id_n,None)
+        self.respawn.add(id_n)
+    
+    def rating(self,id_n):
+        if id_n not in self.ratings:
+            row=self.rows[id_n]
+            values=[
+                row['has_note'],
+                (row['attr'] or "").strip(),
+                (row['program'] or "").strip(),
+                self._filter(self.children[id_n],id_n),
+                row['parent_id']==id_n,
+                row['locked'],
+                row['hidden'],
+                row['silent'],
+                row['tunnel'],
+            ]
+            self.ratings[id_n]=int((sum(map(bool,values))/len(values))*100)
+        return self.ratings[id_n]
+    
+    def rating_of(self,vessel):
+        self.ensure()
+        id_n=_vessel_id(vessel)
+        if id_n not in self.rows:
+            return 0
+        return self.rating(id_n)
+    
+    def resolve(self,name,candidates=None,attr_only=False):
+        # exact attribute and name, then name, then attribute; first match in candidates order (or lowest id)
+        self.ensure()
+        attr,name=split_vessel_name(name.lower())
+        tiers=[("attr_name",attr,name),("name",name),("attr",name)]
+        if attr_only:
+            tiers=tiers[2:]
+        for key in tiers:
+            ids=self.names.get(key)
+            if not ids:
+                continue
+            if candidates is None:
+                return min(ids)
+            for id_n in candidates:
+                if id_n in ids:
+                    return id_n
+    
+    def render_note(self,vessel,note):
+        # tag tunnels as |name| and visible vessels as [name] (^ for programmed ones) in one pass
+        visible=self.visible_of(vessel)
+        id_n=_vessel_id(vessel)
+        key=(hash(note),self.tunnel_version,tuple(visible),tuple(self.versions[i] for i in visible))
+        cached=self.notes.get(id_n)
+        if cached is not None and cached[0]==key:
+            return cached[1]
+        self.tunnel_matcher()
+        tags={}
+        for ids,template in ((self.tunnel_ids,"|{}|"),(visible,"[{}]")):
+            for i in ids:
+                row=self.rows[i]
+                full_name="{} {}".format(row['attr'],row['name']).strip()
+                if len(full_name)>2 and full_name not in tags:
+                    tags[full_name]=("^"+template if row['program'] else template).format(full_name)
+        rendered=note
+        if tags:
+            pattern=re.compile("|".join(map(re.escape,sorted(tags,key=len,reverse=True))))
+            rendered=pattern.sub(lambda match:tags[match.group(0)],note)
+        self.notes[id_n]=(key,rendered)
+        return rendered
+    
+    def _shown(self,i,id_n):
+        # whether vessel i shows up in the children/siblings of vessel id_n
+        row=self.rows[id_n]
+        if i==id_n or not self.rows[i]['name']:
+            return False
+        return not row['silent'] or self.rows[i]['owner_id'] in (row['owner_id'],id_n)
+    
+    def _filter(self,ids,id_n):
+        return {i for i in ids if self._shown(i,id_n)}
+    
+    def children_of(self,vessel):
+        self.ensure()
+        id_n=_vessel_id(vessel)
+        if id_n not in self.rows:
+            return set()
+        return self._filter(self.children[id_n],id_n)
+    
+    def siblings_of(self,vessel):
+        self.ensure()
+        id_n=_vessel_id(vessel)
+        if id_n not in self.rows:
+            return set()
+        parent_id=self.rows[id_n]['parent_id']
+        return self._filter(self.children[parent_id]-{parent_id},id_n)
+    
+    def sample_children(self,vessel,num=1):
+        # draw from the parent's pool and skip hidden entries, scanning all children only if that keeps missing
+        self.ensure()
+        id_n=_vessel_id(vessel)
+        if id_n not in self.rows:
+            return []
+        pool=self.children[id_n]
+        picked=[]
+        for _ in range(min(len(pool),4*num+8)):
+            i=pool.choice()
+            if i not in picked and self._shown(i,id_n):
+                picked.append(i)
+                if len(picked)==num:
+                    return picked
+        ids=sorted(self.children_of(vessel))
+        return random.sample(ids,min(num,len(ids)))
+    
+    def visible_of(self,vessel):
+        siblings=self.siblings_of(vessel)
+        return sorted(siblings)+sorted(self.children_of(vessel)-siblings)
+
+index=VesselIndex()
+
+def _vessel_id(target):
+    state=inspect(target)
+    if state.has_identity:
+        return state.identity[0]
+
+def _index_setter(key):
+    def listener(target,value,oldvalue,initiator):
+        id_n=_vessel_id(target)
+        if index.loaded and id_n is not None:
+            index.update(id_n,key,value)
+    return listener
+
+for key in VesselIndex.columns:
+    event.listen(getattr(Vessel,key),'set',_index_setter(key))
+
+@event.listens_for(Vessel.raw_note,'set')
+def _index_note(target,value,oldvalue,initiator):
+    id_n=_vessel_id(target)
+    if index.loaded and id_n is not None:
+        index.note_changed(id_n,value)
+
+@event.listens_for(Vessel,'after_insert')
+def _index_insert(mapper,connection,target):
+    if index.loaded:
+        row={c:getattr(target,c) for c in index.columns}
+        row['has_note']=bool((target.raw_note or "").strip())
+        index.insert(target.id,row)
+        index.note_changed(target.id,target.raw_note)
+
+@event.listens_for(Vessel,'after_delete')
+def _index_delete(mapper,connection,target):
+    if index.loaded:
+        index.remove(target.id)
+
+event.listen(session,'after_soft_rollback',index.reset)
+event.listen(Vessel.__table__,'after_create',_create_change_log)
+event.listen(Vessel.__table__,'after_drop',_log_reset)
+event.listen(Vessel.__table__,'after_create',index.reset)
+event.listen(Vessel.__table__,'after_drop',index.reset)
+
+migrate()